@@ -27,8 +27,11 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv("SECRET_KEY")
 
+# Lean production profile: no debug, no dev-only apps and middleware, for a faster cold start
+PRODUCTION = os.getenv("DJANGO_ENV") == "production"
+
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = not PRODUCTION
 
 ALLOWED_HOSTS = [
     "*",
@@ -50,6 +53,14 @@ INSTALLED_APPS = [
     "api",
 ]
 
+# The API does not use the admin, sessions or messages, they are only kept for development
+DEV_ONLY_APPS = [
+    "django.contrib.admin",
+    "django.contrib.sessions",
+    "django.contrib.messages",
+    "django_extensions",
+]
+
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
@@ -61,6 +72,18 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
+DEV_ONLY_MIDDLEWARE = [
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "django.contrib.messages.middleware.MessageMiddleware",
+]
+
+if PRODUCTION:
+    INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in DEV_ONLY_APPS]
+    MIDDLEWARE = [
+        middleware for middleware in MIDDLEWARE if middleware not in DEV_ONLY_MIDDLEWARE
+    ]
+
 # Allow all origins for now (you can restrict this later)
 CORS_ALLOW_ALL_ORIGINS = True
 
@@ -121,6 +144,50 @@ DATABASES = {
     }
 }
 
+# Read replicas used by the analytics endpoints, as a comma separated list of hosts. Without
+# replicas the analytics endpoints still get their own connections to the default database.
+DB_REPLICA_HOSTS = [host for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host]
+
+# The analytics endpoints can connect with a role of their own. Setting a CONNECTION LIMIT on
+# that role caps the analytics connections of all the processes together.
+DATABASES.update(
+    {
+        f"analytics_{index}": {
+            **DATABASES["default"],
+            "HOST": host,
+            "USER": os.getenv("DB_ANALYTICS_USER", DATABASES["default"]["USER"]),
+            "PASSWORD": os.getenv(
+                "DB_ANALYTICS_PASSWORD", DATABASES["default"]["PASSWORD"]
+            ),
+            # The analytics threads are long-lived, so their connections are reused
+            "CONN_MAX_AGE": int(os.getenv("ANALYTICS_CONN_MAX_AGE", 60)),
+            "TEST": {"MIRROR": "default"},
+        }
+        for index, host in enumerate(DB_REPLICA_HOSTS or [DATABASES["default"]["HOST"]])
+    }
+)
+
+ANALYTICS_DATABASES = [alias for alias in DATABASES if alias.startswith("analytics_")]
+
+DATABASE_ROUTERS = ["api.routers.AnalyticsRouter"]
+
+# Number of analytics threads, and so of analytics connections, per process, and how long
+# (seconds) a request waits for a thread. The budget is per process: with N workers up to
+# N x ANALYTICS_MAX_CONNECTIONS analytics connections can be open, use the role above to cap them.
+ANALYTICS_MAX_CONNECTIONS = int(os.getenv("ANALYTICS_MAX_CONNECTIONS", 4))
+ANALYTICS_QUEUE_TIMEOUT = float(os.getenv("ANALYTICS_QUEUE_TIMEOUT", 2))
+
+# Statement timeouts (milliseconds) of the analytics endpoints
+ANALYTICS_STATEMENT_TIMEOUT = int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT", 5000))
+ANALYTICS_STATEMENT_TIMEOUTS = {
+    "speed-heatmap": int(
+        os.getenv("SPEED_HEATMAP_STATEMENT_TIMEOUT", ANALYTICS_STATEMENT_TIMEOUT)
+    ),
+    "trip-heatmap": int(
+        os.getenv("TRIP_HEATMAP_STATEMENT_TIMEOUT", ANALYTICS_STATEMENT_TIMEOUT)
+    ),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -1,23 +1,30 @@
-import geojson
-import httpx
 from asgiref.sync import sync_to_async
 from django.contrib.gis.geos import Point
-from django.db.models import Avg, Max, Min
 from django.http import JsonResponse
+from django.utils import timezone
 from ninja import NinjaAPI
 from ninja.errors import HttpError
-from shapely.geometry import LineString, Point
 
-from .models import SpeedRecord
-from .schema import SpeedRequestSchema
+from .models import Job, SpeedRecord, Trip
+from .routers import AnalyticsUnavailable, run_analytics
+from .schema import JobRequestSchema, SpeedRequestSchema
 
-# from .utils import interpolate_speed_differences, segment_trips
+# The filters, rollups and jobs modules load numpy, so they are imported inside the views
+# that use them to keep the worker startup fast.
 
 api = NinjaAPI()
 
 
+@api.exception_handler(AnalyticsUnavailable)
+def analytics_unavailable(request, exc):
+    return api.create_response(request, {"detail": str(exc)}, status=503)
+
+
 # This function will use the Overpass API to get the nearest road to a given latitude and longitude.
 async def get_nearest_road(lat, lon):
+    # httpx is imported on first use to keep the worker startup fast
+    import httpx
+
     overpass_url = "https://overpass-api.de/api/interpreter"
     overpass_query = f"""
     [out:json];
@@ -32,6 +39,9 @@ async def get_nearest_road(lat, lon):
 
 # This function will get the speed limit of the nearest road to a given latitude and longitude.
 def get_speed_limit(road_data, lat, lon):
+    # shapely is imported on first use to keep the worker startup fast
+    from shapely.geometry import LineString, Point
+
     point = Point(lon, lat)
     nearest_way = None
     min_distance = float("inf")
@@ -73,6 +83,10 @@ async def get_speed_info(request, payload: SpeedRequestSchema):
     lat = payload.lat
     lon = payload.lon
     user_speed = payload.user_speed
+    device_id = payload.device_id
+
+    from .filters import get_recent_fixes, is_outlier_fix
+    from .rollups import save_speed_record
 
     try:
         road_data = await get_nearest_road(lat, lon)
@@ -88,7 +102,16 @@ async def get_speed_info(request, payload: SpeedRequestSchema):
             speed_difference = speed_difference
 
         location_point = Point(lon, lat, srid=4326)
-        # Save the speed record to the database
+
+        # Flag implausible fixes so the heatmap aggregations can exclude them
+        recent_fixes = []
+        if device_id:
+            recent_fixes = await sync_to_async(get_recent_fixes)(device_id)
+        is_outlier = is_outlier_fix(
+            lat, lon, user_speed, timezone.now(), recent_fixes, device_id
+        )
+
+        # Save the speed record to the database, along with its heatmap rollup
         speed_record = SpeedRecord(
             location=location_point,
             latitude=lat,
@@ -96,8 +119,10 @@ async def get_speed_info(request, payload: SpeedRequestSchema):
             current_speed=user_speed,
             road_speed_limit=speed_limit,
             speed_difference=speed_difference,
+            device_id=device_id,
+            is_outlier=is_outlier,
         )
-        await sync_to_async(speed_record.save)()
+        await sync_to_async(save_speed_record)(speed_record)
 
         return {
             "latitude": lat,
@@ -105,160 +130,110 @@ async def get_speed_info(request, payload: SpeedRequestSchema):
             "user_speed": user_speed,
             "road_speed_limit": speed_limit,
             "speed_difference": speed_difference,
+            "is_outlier": is_outlier,
         }
     except Exception as e:
         raise HttpError(500, f"Internal server error: {e}")
 
 
 @api.get("/speed-heatmap")
-def get_speed_heatmap(request):
-    try:
-        # Aggregate min, max, and avg speed differences for each unique location (road/point)
-        aggregated_data = (
-            SpeedRecord.objects.values("location")
-            .annotate(
-                avg_speed_diff=Avg("speed_difference"),
-                min_speed_diff=Min("speed_difference"),
-                max_speed_diff=Max("speed_difference"),
-            )
-            .values("location", "avg_speed_diff", "min_speed_diff", "max_speed_diff")
-        )
-
-        # Prepare the data for the GeoJSON response
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": [
-                {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [record["location"].x, record["location"].y],
+async def get_speed_heatmap(request, cell_factor: int = 1):
+    if cell_factor < 1:
+        raise HttpError(422, "cell_factor must be at least 1")
+
+    geojson_data = await run_analytics(
+        "speed-heatmap", build_speed_heatmap, cell_factor
+    )
+    return JsonResponse(geojson_data)
+
+
+# This function will build the speed heatmap GeoJSON, it runs on the analytics databases.
+def build_speed_heatmap(cell_factor):
+    from .rollups import (
+        PERCENTILES,
+        get_cell_centers,
+        get_heatmap_cells,
+        histogram_percentiles,
+    )
+
+    # Read the per-cell rollups (outliers are never added to them), merging blocks of
+    # cell_factor x cell_factor cells for coarser maps
+    cells = get_heatmap_cells(cell_factor)
+    lons, lats = get_cell_centers(cells["cell_x"], cells["cell_y"], cell_factor)
+    percentiles = histogram_percentiles(cells["histogram"], PERCENTILES)
+
+    # Prepare the data for the GeoJSON response
+    geojson_data = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [float(lons[i]), float(lats[i])],
+                },
+                "properties": {
+                    "record_count": int(cells["record_count"][i]),
+                    "avg_speed_difference": float(
+                        cells["speed_difference_sum"][i] / cells["record_count"][i]
+                    ),
+                    "min_speed_difference": int(cells["min_speed_difference"][i]),
+                    "max_speed_difference": int(cells["max_speed_difference"][i]),
+                    **{
+                        f"p{percentile}_speed_difference": int(percentiles[i][j])
+                        for j, percentile in enumerate(PERCENTILES)
                     },
-                    "properties": {
-                        "avg_speed_difference": record["avg_speed_diff"],
-                        "min_speed_difference": record["min_speed_diff"],
-                        "max_speed_difference": record["max_speed_diff"],
-                    }
-                }
-                for record in aggregated_data
-            ]
-        }
+                },
+            }
+            for i in range(len(lons))
+        ],
+    }
 
-        return JsonResponse(geojson_data)
-    except Exception as e:
-        raise HttpError(500, f"Internal server error: {e}")
+    return geojson_data
+
+
+# The trip heatmap is too expensive to compute inside a request, its trips are built by the
+# trip_heatmap background job and this endpoint only reads them.
+@api.get("/trip-heatmap")
+async def get_trip_heatmap(request):
+    features = await run_analytics("trip-heatmap", get_trip_features)
+    return JsonResponse({"type": "FeatureCollection", "features": features})
+
+
+# This function will return the GeoJSON features of the trips, it runs on the analytics databases.
+def get_trip_features():
+    return list(
+        Trip.objects.filter(feature__isnull=False)
+        .order_by("started_at")
+        .values_list("feature", flat=True)
+    )
 
 
-# @api.get("/speed-heatmap")
-# async def get_speed_heatmap(request):
-#     try:
-#         print("Fetching all speed records...")
-#         # Retrieve all SpeedRecord data
-#         speed_records = await sync_to_async(list)(
-#             SpeedRecord.objects.all().order_by("timestamp")
-#         )
-#         print(f"Fetched {len(speed_records)} speed records")
-
-#         if not speed_records:
-#             print("No speed records found")
-#             return JsonResponse({"detail": "No speed records found"}, status=404)
-
-#         # Segment the data into trips
-#         print("Segmenting trips...")
-#         segmented_trips = segment_trips(speed_records)
-#         print(f"Segmented into {len(segmented_trips)} trips")
-
-#         if len(segmented_trips) > 1:
-#             # Interpolating speed differences for each trip
-#             all_interpolated_points = []
-#             all_interpolated_speeds = []
-
-#             for trip in segmented_trips:
-#                 print(f"Interpolating trip with {len(trip)} points...")
-#                 points, speeds = interpolate_speed_differences(trip)
-#                 if not points or not speeds:
-#                     print("Interpolation returned empty lists")
-#                 else:
-#                     print(f"Interpolated {len(points)} points and {len(speeds)} speeds")
-#                 all_interpolated_points.extend(points)
-#                 all_interpolated_speeds.extend(speeds)
-#                 print(f"All interpolated points so far: {len(all_interpolated_points)}")
-#                 print(f"All interpolated speeds so far: {len(all_interpolated_speeds)}")
-
-#             # Flatten the lists (already flattened in the above step)
-#             print(
-#                 f"Flattened to {len(all_interpolated_points)} total points and {len(all_interpolated_speeds)} total speeds"
-#             )
-
-#             # Calculate average speed differences for overlapping segments
-#             point_speed_map = {}
-#             for pt, spd in zip(all_interpolated_points, all_interpolated_speeds):
-#                 coord = (pt.x, pt.y)
-#                 if coord not in point_speed_map:
-#                     point_speed_map[coord] = []
-#                 point_speed_map[coord].append(spd)
-#             print(
-#                 f"Calculated average speed differences for {len(point_speed_map)} points"
-#             )
-
-#             print("Calculating averaged points and speeds...")
-#             averaged_points = []
-#             averaged_speeds = []
-#             for coord, speeds in point_speed_map.items():
-#                 # Filter out 0 values
-#                 valid_speeds = [spd for spd in speeds if spd != 0]
-#                 print(f"Valid speeds: {valid_speeds}")
-#                 if valid_speeds:
-#                     averaged_points.append(Point(coord))
-#                     averaged_speeds.append(sum(valid_speeds) / len(valid_speeds))
-#                     print(
-#                         f"Averaged to {len(averaged_points)} points with corresponding speeds"
-#                     )
-
-#             # Create GeoJSON features
-#             if not averaged_points:
-#                 print("Not enough data points to create LineString features")
-#                 print(f"Point-speed map: {point_speed_map}")
-#                 print(f"Averaged points: {averaged_points}")
-#                 print(f"Averaged speeds: {averaged_speeds}")
-#                 return JsonResponse(
-#                     {"detail": "Not enough data points to create LineString features"},
-#                     status=400,
-#                 )
-
-#             line = LineString([(pt.x, pt.y) for pt in averaged_points])
-#             feature = geojson.Feature(
-#                 geometry=line, properties={"average_speed_differences": averaged_speeds}
-#             )
-
-#             feature_collection = geojson.FeatureCollection([feature])
-#             print("Successfully created GeoJSON feature collection")
-#             return JsonResponse(feature_collection, safe=False)
-
-#         # Create GeoJSON features for each trip
-#         features = []
-#         for trip in segmented_trips:
-#             coordinates = [(record.longitude, record.latitude) for record in trip]
-#             speed_differences = [record.speed_difference for record in trip]
-
-#             if len(coordinates) < 2:
-#                 continue  # Skip trips with not enough data points
-
-#             line = LineString(coordinates)
-#             feature = geojson.Feature(
-#                 geometry=line, properties={"speed_differences": speed_differences}
-#             )
-#             features.append(feature)
-
-#         if not features:
-#             return JsonResponse(
-#                 {"detail": "Not enough data points to create LineString features"},
-#                 status=400,
-#             )
-
-#         feature_collection = geojson.FeatureCollection(features)
-#         return JsonResponse(feature_collection, safe=False)
-
-#     except Exception as e:
-#         print(f"Error occurred: {str(e)}")
-#         return JsonResponse({"detail": str(e)}, status=500)
+# This function will return the status of a background job.
+def serialize_job(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+@api.post("/jobs")
+def create_job(request, payload: JobRequestSchema):
+    from .jobs import enqueue_job
+
+    job = enqueue_job(payload.kind)
+    return serialize_job(job)
+
+
+@api.get("/jobs/{job_id}")
+def get_job(request, job_id: int):
+    try:
+        job = Job.objects.get(id=job_id)
+    except Job.DoesNotExist:
+        raise HttpError(404, "Job not found")
+    return serialize_job(job)
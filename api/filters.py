@@ -0,0 +1,124 @@
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+
+from .models import SpeedRecord
+
+# Speeds (km/h) outside of these bounds are treated as sensor glitches.
+MIN_PLAUSIBLE_SPEED = 0
+MAX_PLAUSIBLE_SPEED = 250
+
+# Maximum speed (km/h) implied by the distance and time between two consecutive fixes
+# of the same device. Anything faster than this is a GPS jump.
+MAX_IMPLIED_SPEED = 300
+
+# Number of fixes used for the rolling median, and how far (km/h) a fix may deviate from it.
+ROLLING_WINDOW = 5
+MAX_MEDIAN_DEVIATION = 80
+
+# Only fixes this recent are compared with a new fix. After a longer gap (the same threshold
+# segment_trips uses to split trips) the speed may legitimately be completely different.
+HISTORY_WINDOW = timedelta(minutes=30)
+
+EARTH_RADIUS = 6371008.8
+
+
+# This function will return the great-circle distance in meters between two arrays of coordinates.
+def haversine_distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+# This function will return the speed (km/h) implied by each fix and the one before it.
+# The first fix has no predecessor, so its implied speed is 0.
+def implied_speeds(latitudes, longitudes, timestamps):
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    distances = haversine_distance(
+        latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]
+    )
+    durations = np.diff(timestamps)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speeds = distances / durations * 3.6
+    # Two fixes at the same place and time are duplicates, not jumps.
+    speeds = np.nan_to_num(speeds, nan=0.0, posinf=np.inf)
+    speeds[(durations <= 0) & (distances > 0)] = np.inf
+
+    return np.concatenate(([0.0], speeds))
+
+
+# This function will return the trailing rolling median of the values. The first values use
+# the shorter window available, so the output has the same length as the input.
+def rolling_median(values, window=ROLLING_WINDOW):
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return values
+    padded = np.concatenate((np.full(window - 1, np.nan), values))
+    return np.nanmedian(np.lib.stride_tricks.sliding_window_view(padded, window), axis=1)
+
+
+# This function will return a boolean mask marking implausible fixes. The fixes must be ordered
+# by timestamp (in seconds). The implied speed check only makes sense for fixes of a single device.
+def flag_outliers(
+    latitudes, longitudes, speeds, timestamps, check_implied_speed=True
+):
+    speeds = np.asarray(speeds, dtype=float)
+
+    outliers = (speeds < MIN_PLAUSIBLE_SPEED) | (speeds > MAX_PLAUSIBLE_SPEED)
+    outliers |= np.abs(speeds - rolling_median(speeds)) > MAX_MEDIAN_DEVIATION
+    if check_implied_speed:
+        outliers |= implied_speeds(latitudes, longitudes, timestamps) > MAX_IMPLIED_SPEED
+
+    return outliers
+
+
+# This function will return the fixes of the device in the last HISTORY_WINDOW, oldest first.
+# Flagged fixes are included so a sustained change of speed stops being flagged once it fills
+# the rolling window.
+def get_recent_fixes(device_id, limit=ROLLING_WINDOW - 1):
+    records = SpeedRecord.objects.filter(
+        device_id=device_id, timestamp__gte=timezone.now() - HISTORY_WINDOW
+    )
+    return list(reversed(records.order_by("-timestamp")[:limit]))
+
+
+# This function will check a new fix against the recent fixes of its device and return True if
+# it is implausible. Without a device id or recent fixes only the speed bounds are checked.
+def is_outlier_fix(lat, lon, speed, timestamp, recent_fixes, device_id=None):
+    # Fixes of other vehicles nearby say nothing about this one, a driver going much faster
+    # than the traffic around is a real speeder, not a sensor glitch
+    if not device_id:
+        return not MIN_PLAUSIBLE_SPEED <= speed <= MAX_PLAUSIBLE_SPEED
+
+    fixes = [
+        (record.latitude, record.longitude, record.current_speed, record.timestamp)
+        for record in recent_fixes
+    ] + [(lat, lon, speed, timestamp)]
+    latitudes, longitudes, speeds, timestamps = zip(*fixes)
+    timestamps = [fix_timestamp.timestamp() for fix_timestamp in timestamps]
+
+    outliers = flag_outliers(
+        latitudes, longitudes, speeds, timestamps, check_implied_speed=False
+    )
+    if outliers[-1]:
+        return True
+
+    # A GPS jump is measured from the last plausible fix, not from the previous jump
+    plausible_fixes = [record for record in recent_fixes if not record.is_outlier]
+    if plausible_fixes:
+        last_fix = plausible_fixes[-1]
+        implied_speed = implied_speeds(
+            [last_fix.latitude, lat],
+            [last_fix.longitude, lon],
+            [last_fix.timestamp.timestamp(), timestamps[-1]],
+        )[-1]
+        return bool(implied_speed > MAX_IMPLIED_SPEED)
+    return False
@@ -0,0 +1,258 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from multiprocessing import get_context
+
+import django
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Job, SpeedRecord, Trip
+from .rollups import rebuild_heatmap, refresh_heatmap
+
+ACTIVE_STATUSES = [Job.Status.PENDING, Job.Status.RUNNING]
+
+# A running job whose heartbeat is older than this lost its worker (OOM, SIGKILL, restart).
+JOB_LEASE = timedelta(minutes=5)
+
+
+# This function will queue a job of the given kind, unless one is already waiting or running.
+def enqueue_job(kind):
+    fail_expired_jobs()
+    while True:
+        job = Job.objects.filter(kind=kind, status__in=ACTIVE_STATUSES).first()
+        if job is not None:
+            return job
+        try:
+            with transaction.atomic():
+                return Job.objects.create(kind=kind)
+        except IntegrityError:
+            # Another request queued the same kind of job in the meantime
+            continue
+
+
+# This function will mark a running job as failed.
+def fail_job(job_id, error):
+    Job.objects.filter(id=job_id, status=Job.Status.RUNNING).update(
+        status=Job.Status.FAILED, error=error, finished_at=timezone.now()
+    )
+
+
+# This function will fail the running jobs whose lease expired, so their kind can run again.
+def fail_expired_jobs():
+    Job.objects.filter(
+        status=Job.Status.RUNNING, heartbeat_at__lt=timezone.now() - JOB_LEASE
+    ).update(
+        status=Job.Status.FAILED,
+        error="The worker running the job was lost",
+        finished_at=timezone.now(),
+    )
+
+
+# This function will claim the oldest pending job. SKIP LOCKED lets several workers poll the
+# queue at the same time without blocking on, or claiming, each other's jobs.
+def claim_job():
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.Status.PENDING)
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = Job.Status.RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.save(update_fields=["status", "started_at", "heartbeat_at"])
+    return job
+
+
+# This function will return the last successful job of the given kind.
+def get_last_done_job(kind):
+    return (
+        Job.objects.filter(kind=kind, status=Job.Status.DONE)
+        .order_by("-finished_at")
+        .first()
+    )
+
+
+# This function will refresh the speed heatmap rollups for the records added since the last run.
+def run_speed_heatmap(since_id, until_id, previous_result):
+    if since_id == 0:
+        return {"updated_cells": rebuild_heatmap()}
+    changed_records = SpeedRecord.objects.filter(
+        id__gt=since_id, id__lte=until_id, is_outlier=False
+    )
+    return {"updated_cells": refresh_heatmap(changed_records)}
+
+
+# This function will return the GeoJSON feature of a trip, or None if it has a single point.
+def get_trip_feature(trip):
+    from .utils import interpolate_speed_differences
+
+    if len(trip) < 2:
+        return None
+    interpolated_points, interpolated_speeds = interpolate_speed_differences(trip)
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [[record.longitude, record.latitude] for record in trip],
+        },
+        "properties": {
+            "speed_differences": [record.speed_difference for record in trip],
+            "interpolated_points": [[pt.x, pt.y] for pt in interpolated_points],
+            "interpolated_speed_differences": interpolated_speeds,
+        },
+    }
+
+
+# This function will rebuild the trips of the devices with records added since the last run.
+# Records without a device id cannot be told apart between vehicles and are left out.
+def run_trip_heatmap(since_id, until_id, previous_result):
+    records = SpeedRecord.objects.filter(is_outlier=False, id__lte=until_id).exclude(
+        device_id=None
+    )
+    # The first run rebuilds every trip, device by device so the map is never served empty
+    rebuild_all = not since_id
+
+    device_ids = list(
+        records.filter(id__gt=since_id).values_list("device_id", flat=True).distinct()
+    )
+    updated_trips = sum(
+        _rebuild_device_trips(
+            device_id, records.filter(device_id=device_id), rebuild_all
+        )
+        for device_id in device_ids
+    )
+    if rebuild_all:
+        # Devices left without plausible records
+        Trip.objects.exclude(device_id__in=device_ids).delete()
+    return {"updated_trips": updated_trips}
+
+
+# This function will segment and interpolate the trips of a device, swapping its trips in a
+# single transaction. Only its last known trip can be extended by new records, so the earlier
+# ones are kept as they are unless all of them are rebuilt.
+@transaction.atomic
+def _rebuild_device_trips(device_id, records, rebuild_all=False):
+    # shapely is only needed by the job workers, not by the API workers importing this module
+    from .utils import segment_trips
+
+    if rebuild_all:
+        Trip.objects.filter(device_id=device_id).delete()
+        last_trip = None
+    else:
+        last_trip = (
+            Trip.objects.filter(device_id=device_id).order_by("-started_at").first()
+        )
+    if last_trip is not None:
+        records = records.filter(timestamp__gte=last_trip.started_at)
+        last_trip.delete()
+
+    trips = Trip.objects.bulk_create(
+        [
+            Trip(
+                device_id=device_id,
+                started_at=trip[0].timestamp,
+                ended_at=trip[-1].timestamp,
+                feature=get_trip_feature(trip),
+            )
+            for trip in segment_trips(records.order_by("timestamp"))
+        ]
+    )
+    return len(trips)
+
+
+JOB_RUNNERS = {
+    Job.Kind.SPEED_HEATMAP: run_speed_heatmap,
+    Job.Kind.TRIP_HEATMAP: run_trip_heatmap,
+}
+
+
+# This function will run a claimed job and persist its result. It runs in the worker processes.
+def execute_job(job_id):
+    try:
+        job = Job.objects.get(id=job_id)
+        previous_job = get_last_done_job(job.kind)
+        since_id = previous_job.last_record_id if previous_job else 0
+        until_id = SpeedRecord.objects.aggregate(Max("id"))["id__max"] or 0
+
+        if previous_job and since_id == until_id:
+            # Nothing changed since the last run
+            result = previous_job.result
+        else:
+            result = JOB_RUNNERS[job.kind](
+                since_id, until_id, previous_job.result if previous_job else None
+            )
+
+        # A job whose lease expired was already failed, its result is dropped
+        Job.objects.filter(id=job_id, status=Job.Status.RUNNING).update(
+            status=Job.Status.DONE,
+            result=result,
+            last_record_id=until_id,
+            finished_at=timezone.now(),
+        )
+    except Exception as e:
+        fail_job(job_id, str(e))
+
+
+# This function will run a job in a pool process, whose connection may have expired since
+# the previous job.
+def _execute_in_worker(job_id):
+    close_old_connections()
+    try:
+        execute_job(job_id)
+    finally:
+        close_old_connections()
+
+
+# This function will poll the queue and run the claimed jobs on a pool of worker processes.
+def run_worker(workers, poll_interval=1.0):
+    while True:
+        # Spawned processes start without the parent's database connections
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=django.setup,
+        ) as pool:
+            _run_pool(pool, workers, poll_interval)
+        # The pool broke because a worker process died, start a new one
+
+
+# This function will feed the pool with jobs until one of its processes dies.
+def _run_pool(pool, workers, poll_interval):
+    running = {}
+    while True:
+        fail_expired_jobs()
+        # Renew the lease of the jobs this worker is running
+        Job.objects.filter(id__in=running.values(), status=Job.Status.RUNNING).update(
+            heartbeat_at=timezone.now()
+        )
+
+        broken = False
+        for future in [future for future in running if future.done()]:
+            job_id = running.pop(future)
+            error = future.exception()
+            if error is not None:
+                fail_job(job_id, f"{type(error).__name__}: {error}")
+                broken = broken or isinstance(error, BrokenProcessPool)
+        if broken:
+            return
+
+        job = claim_job() if len(running) < workers else None
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            running[pool.submit(_execute_in_worker, job.id)] = job.id
+        except BrokenProcessPool:
+            # The job never started, put it back in the queue for the next pool
+            Job.objects.filter(id=job.id).update(
+                status=Job.Status.PENDING, started_at=None, heartbeat_at=None
+            )
+            for job_id in running.values():
+                fail_job(job_id, "BrokenProcessPool: a worker process died")
+            return
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.rollups import rebuild_heatmap
+
+
+class Command(BaseCommand):
+    help = "Rebuild the speed heatmap rollups from all plausible speed records."
+
+    def handle(self, *args, **options):
+        cell_count = rebuild_heatmap()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {cell_count} heatmap cells"))
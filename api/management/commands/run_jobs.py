@@ -0,0 +1,17 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Run the queued background jobs on a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Running jobs with {options['workers']} workers")
+        run_worker(options["workers"], options["poll_interval"])
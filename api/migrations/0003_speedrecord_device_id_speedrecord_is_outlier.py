@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# Speed bounds (km/h) of api.filters when this migration was written. The stored records
+# have no device id, so like any fix without one they are only checked against the bounds.
+MIN_PLAUSIBLE_SPEED = 0
+MAX_PLAUSIBLE_SPEED = 250
+
+
+# Flag the implausible records stored before the outlier filter existed, so the heatmap
+# rollups backfilled later leave them out.
+def flag_existing_outliers(apps, schema_editor):
+    SpeedRecord = apps.get_model("api", "SpeedRecord")
+    implausible = Q(current_speed__lt=MIN_PLAUSIBLE_SPEED) | Q(
+        current_speed__gt=MAX_PLAUSIBLE_SPEED
+    )
+    SpeedRecord.objects.filter(implausible).update(is_outlier=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_speedrecord_location"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="speedrecord",
+            name="device_id",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="speedrecord",
+            name="is_outlier",
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(flag_existing_outliers, migrations.RunPython.noop),
+    ]
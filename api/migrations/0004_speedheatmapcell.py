@@ -0,0 +1,55 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_speedrecord_device_id_speedrecord_is_outlier"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpeedHeatmapCell",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("cell_x", models.IntegerField()),
+                ("cell_y", models.IntegerField()),
+                (
+                    "location",
+                    django.contrib.gis.db.models.fields.PointField(
+                        geography=True, srid=4326
+                    ),
+                ),
+                ("record_count", models.IntegerField(default=0)),
+                ("speed_difference_sum", models.BigIntegerField(default=0)),
+                ("min_speed_difference", models.IntegerField(null=True)),
+                ("max_speed_difference", models.IntegerField(null=True)),
+                (
+                    "histogram",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.IntegerField(), size=101
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("cell_x", "cell_y"), name="unique_speed_heatmap_cell"
+                    )
+                ],
+            },
+        ),
+    ]
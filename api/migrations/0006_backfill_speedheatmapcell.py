@@ -0,0 +1,72 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+import math
+
+from django.contrib.gis.geos import Point
+from django.db import migrations
+
+# Grid and histogram of api.rollups when this migration was written
+CELL_SIZE = 0.0005
+HISTOGRAM_BUCKETS = 101
+
+
+# Build the heatmap rollups of the records stored before they existed, so /speed-heatmap is
+# not empty after the deploy.
+def backfill_heatmap(apps, schema_editor):
+    SpeedRecord = apps.get_model("api", "SpeedRecord")
+    SpeedHeatmapCell = apps.get_model("api", "SpeedHeatmapCell")
+
+    cells = {}
+    records = SpeedRecord.objects.filter(is_outlier=False).values_list(
+        "latitude", "longitude", "speed_difference"
+    )
+    for latitude, longitude, speed_difference in records.iterator():
+        key = (
+            math.floor(longitude / CELL_SIZE),
+            math.floor(latitude / CELL_SIZE),
+        )
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = {
+                "record_count": 0,
+                "speed_difference_sum": 0,
+                "min_speed_difference": speed_difference,
+                "max_speed_difference": speed_difference,
+                "histogram": [0] * HISTOGRAM_BUCKETS,
+            }
+        cell["record_count"] += 1
+        cell["speed_difference_sum"] += speed_difference
+        if speed_difference < cell["min_speed_difference"]:
+            cell["min_speed_difference"] = speed_difference
+        if speed_difference > cell["max_speed_difference"]:
+            cell["max_speed_difference"] = speed_difference
+        # The last bucket collects everything above it
+        bucket = min(max(speed_difference, 0), HISTOGRAM_BUCKETS - 1)
+        cell["histogram"][bucket] += 1
+
+    SpeedHeatmapCell.objects.all().delete()
+    SpeedHeatmapCell.objects.bulk_create(
+        [
+            SpeedHeatmapCell(
+                cell_x=cell_x,
+                cell_y=cell_y,
+                location=Point(
+                    (cell_x + 0.5) * CELL_SIZE, (cell_y + 0.5) * CELL_SIZE, srid=4326
+                ),
+                **fields,
+            )
+            for (cell_x, cell_y), fields in cells.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_job"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_heatmap, migrations.RunPython.noop),
+    ]
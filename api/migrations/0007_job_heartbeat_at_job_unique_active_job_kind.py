@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+# Keep only the oldest waiting or running job of each kind, so the constraint can be added.
+def fail_duplicate_active_jobs(apps, schema_editor):
+    Job = apps.get_model("api", "Job")
+
+    active_jobs = Job.objects.filter(status__in=["pending", "running"])
+    kept_ids = set()
+    for kind in active_jobs.values_list("kind", flat=True).distinct():
+        kept_ids.add(active_jobs.filter(kind=kind).order_by("created_at").first().id)
+    active_jobs.exclude(id__in=kept_ids).update(
+        status="failed", error="Duplicate of another queued job"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_backfill_speedheatmapcell"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="heartbeat_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fail_duplicate_active_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="job",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status__in", ["pending", "running"])),
+                fields=("kind",),
+                name="unique_active_job_kind",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_job_heartbeat_at_job_unique_active_job_kind"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="speedrecord",
+            index=models.Index(
+                fields=["latitude", "longitude"], name="api_speedrecord_lat_lon_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_speedrecord_api_speedrecord_lat_lon_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Trip",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("device_id", models.CharField(max_length=64)),
+                ("started_at", models.DateTimeField()),
+                ("ended_at", models.DateTimeField()),
+                ("feature", models.JSONField(null=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["device_id", "started_at"],
+                        name="api_trip_device_started_idx",
+                    )
+                ],
+            },
+        ),
+    ]
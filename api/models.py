@@ -1,6 +1,11 @@
 from django.contrib.gis.db import models as gis_models
+from django.contrib.postgres.fields import ArrayField
 from django.db import models
 
+# Speed differences (km/h over the limit) are counted in 1 km/h buckets, the last bucket
+# collects everything at or above HISTOGRAM_BUCKETS - 1.
+HISTOGRAM_BUCKETS = 101
+
 
 class SpeedRecord(models.Model):
     location = gis_models.PointField(geography=True, srid=4326, null=True)
@@ -10,6 +15,105 @@ class SpeedRecord(models.Model):
     road_speed_limit = models.IntegerField()
     speed_difference = models.IntegerField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    device_id = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # Set at ingest for implausible fixes (GPS jumps, sensor glitches) so aggregations can skip them.
+    is_outlier = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Used to load the records of a heatmap cell
+            models.Index(
+                fields=["latitude", "longitude"], name="api_speedrecord_lat_lon_idx"
+            )
+        ]
 
     def __str__(self):
         return f"SpeedRecord at ({self.latitude}, {self.longitude})"
+
+
+# Rollup of the plausible speed records in a grid cell of the heatmap. The histogram is
+# mergeable, so percentiles of any group of cells can be computed without the raw records.
+class SpeedHeatmapCell(models.Model):
+    cell_x = models.IntegerField()
+    cell_y = models.IntegerField()
+    location = gis_models.PointField(geography=True, srid=4326)
+    record_count = models.IntegerField(default=0)
+    speed_difference_sum = models.BigIntegerField(default=0)
+    min_speed_difference = models.IntegerField(null=True)
+    max_speed_difference = models.IntegerField(null=True)
+    histogram = ArrayField(models.IntegerField(), size=HISTOGRAM_BUCKETS)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cell_x", "cell_y"], name="unique_speed_heatmap_cell"
+            )
+        ]
+
+    def __str__(self):
+        return f"SpeedHeatmapCell ({self.cell_x}, {self.cell_y})"
+
+
+# Background job for the geospatial computations that are too expensive to run inside a request.
+# Jobs are queued in this table and claimed by the run_jobs workers with SKIP LOCKED.
+class Job(models.Model):
+    class Kind(models.TextChoices):
+        SPEED_HEATMAP = "speed_heatmap"
+        TRIP_HEATMAP = "trip_heatmap"
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    kind = models.CharField(max_length=32, choices=Kind.choices)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.PENDING
+    )
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    # Highest SpeedRecord id included in the result, so the next run only processes newer records.
+    last_record_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    # Renewed by the worker while the job runs, a running job without a recent heartbeat is lost.
+    heartbeat_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "created_at"], name="api_job_status_created_idx"
+            )
+        ]
+        constraints = [
+            # At most one waiting or running job of each kind
+            models.UniqueConstraint(
+                fields=["kind"],
+                condition=models.Q(status__in=["pending", "running"]),
+                name="unique_active_job_kind",
+            )
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}, {self.status})"
+
+
+# Trip of a single device, built by the trip_heatmap job with its GeoJSON feature.
+class Trip(models.Model):
+    device_id = models.CharField(max_length=64)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    feature = models.JSONField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["device_id", "started_at"], name="api_trip_device_started_idx"
+            )
+        ]
+
+    def __str__(self):
+        return f"Trip of {self.device_id} at {self.started_at}"
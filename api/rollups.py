@@ -0,0 +1,311 @@
+from functools import reduce
+from operator import or_
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.db.models import Q
+
+from .models import HISTOGRAM_BUCKETS, SpeedHeatmapCell, SpeedRecord
+
+# Size of a heatmap grid cell in degrees (about 50 m of latitude).
+CELL_SIZE = 0.0005
+
+# Number of cells recomputed per query and transaction by refresh_heatmap.
+REFRESH_BATCH_SIZE = 200
+
+# Percentiles of the speed difference returned for every heatmap cell.
+PERCENTILES = (50, 85, 95)
+
+CELL_FIELDS = (
+    "cell_x",
+    "cell_y",
+    "record_count",
+    "speed_difference_sum",
+    "min_speed_difference",
+    "max_speed_difference",
+    "histogram",
+)
+
+
+# This function will return the grid cell indexes of the given coordinates.
+def get_cells(latitudes, longitudes):
+    cell_x = np.floor(np.asarray(longitudes, dtype=float) / CELL_SIZE).astype(np.int64)
+    cell_y = np.floor(np.asarray(latitudes, dtype=float) / CELL_SIZE).astype(np.int64)
+    return cell_x, cell_y
+
+
+# This function will return the (lon, lat) center of the given grid cells. A factor greater
+# than 1 means the cells are blocks of factor x factor base cells.
+def get_cell_centers(cell_x, cell_y, factor=1):
+    size = CELL_SIZE * factor
+    return (np.asarray(cell_x) + 0.5) * size, (np.asarray(cell_y) + 0.5) * size
+
+
+# This function will return the histogram bucket of each speed difference.
+def get_buckets(speed_differences):
+    return np.clip(np.asarray(speed_differences), 0, HISTOGRAM_BUCKETS - 1).astype(
+        np.int64
+    )
+
+
+# This function will return the unique cells and, for every input, the index of its cell.
+def _group_cells(cell_x, cell_y):
+    keys, inverse = np.unique(
+        np.column_stack((cell_x, cell_y)), axis=0, return_inverse=True
+    )
+    return keys[:, 0], keys[:, 1], inverse.reshape(-1)
+
+
+# This function will aggregate raw speed records into heatmap cells.
+def aggregate_records(latitudes, longitudes, speed_differences):
+    speed_differences = np.asarray(speed_differences, dtype=np.int64)
+    cell_x, cell_y, inverse = _group_cells(*get_cells(latitudes, longitudes))
+    size = len(cell_x)
+
+    record_count = np.bincount(inverse, minlength=size)
+    speed_difference_sum = np.bincount(
+        inverse, weights=speed_differences, minlength=size
+    ).astype(np.int64)
+    min_speed_difference = np.full(size, np.iinfo(np.int64).max)
+    np.minimum.at(min_speed_difference, inverse, speed_differences)
+    max_speed_difference = np.full(size, np.iinfo(np.int64).min)
+    np.maximum.at(max_speed_difference, inverse, speed_differences)
+    histogram = np.zeros((size, HISTOGRAM_BUCKETS), dtype=np.int64)
+    np.add.at(histogram, (inverse, get_buckets(speed_differences)), 1)
+
+    return {
+        "cell_x": cell_x,
+        "cell_y": cell_y,
+        "record_count": record_count,
+        "speed_difference_sum": speed_difference_sum,
+        "min_speed_difference": min_speed_difference,
+        "max_speed_difference": max_speed_difference,
+        "histogram": histogram,
+    }
+
+
+# This function will merge blocks of factor x factor heatmap cells into coarser cells.
+def merge_cells(cells, factor):
+    cell_x, cell_y, inverse = _group_cells(
+        np.floor_divide(cells["cell_x"], factor),
+        np.floor_divide(cells["cell_y"], factor),
+    )
+    size = len(cell_x)
+
+    record_count = np.bincount(
+        inverse, weights=cells["record_count"], minlength=size
+    ).astype(np.int64)
+    speed_difference_sum = np.bincount(
+        inverse, weights=cells["speed_difference_sum"], minlength=size
+    ).astype(np.int64)
+    min_speed_difference = np.full(size, np.iinfo(np.int64).max)
+    np.minimum.at(min_speed_difference, inverse, cells["min_speed_difference"])
+    max_speed_difference = np.full(size, np.iinfo(np.int64).min)
+    np.maximum.at(max_speed_difference, inverse, cells["max_speed_difference"])
+    histogram = np.zeros((size, HISTOGRAM_BUCKETS), dtype=np.int64)
+    np.add.at(histogram, inverse, cells["histogram"])
+
+    return {
+        "cell_x": cell_x,
+        "cell_y": cell_y,
+        "record_count": record_count,
+        "speed_difference_sum": speed_difference_sum,
+        "min_speed_difference": min_speed_difference,
+        "max_speed_difference": max_speed_difference,
+        "histogram": histogram,
+    }
+
+
+# This function will return the given percentiles of every histogram, as one row per histogram.
+# Values in the last bucket are reported as its lower bound.
+def histogram_percentiles(histograms, percentiles=PERCENTILES):
+    histograms = np.asarray(histograms, dtype=np.int64).reshape(-1, HISTOGRAM_BUCKETS)
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1:]
+
+    result = np.empty((len(histograms), len(percentiles)), dtype=np.int64)
+    for i, percentile in enumerate(percentiles):
+        ranks = np.maximum(np.ceil(totals * percentile / 100), 1)
+        result[:, i] = np.argmax(cumulative >= ranks, axis=1)
+    return result
+
+
+# The rollups are written both at ingest and by the speed_heatmap job. To never count a record
+# twice, a record is saved in the same transaction as its rollup increment, and the job locks
+# the cells before reading the records it recomputes them from. A record is then either
+# committed before the job reads it, or its increment waits for the job to commit.
+
+
+# This function will save a speed record and, if it is plausible, add it to its heatmap cell.
+@transaction.atomic
+def save_speed_record(record):
+    record.save()
+    if not record.is_outlier:
+        add_record_to_heatmap(record)
+
+
+# This function will add a plausible speed record to the rollup of its heatmap cell.
+@transaction.atomic
+def add_record_to_heatmap(record):
+    cell_x, cell_y = get_cells(record.latitude, record.longitude)
+    cell, _ = SpeedHeatmapCell.objects.select_for_update().get_or_create(
+        cell_x=int(cell_x),
+        cell_y=int(cell_y),
+        defaults=_empty_cell_fields(cell_x, cell_y),
+    )
+    speed_difference = record.speed_difference
+
+    cell.record_count += 1
+    cell.speed_difference_sum += speed_difference
+    if cell.min_speed_difference is None:
+        cell.min_speed_difference = cell.max_speed_difference = speed_difference
+    else:
+        cell.min_speed_difference = min(cell.min_speed_difference, speed_difference)
+        cell.max_speed_difference = max(cell.max_speed_difference, speed_difference)
+    cell.histogram[int(get_buckets(speed_difference))] += 1
+    cell.save()
+
+
+# This function will return the fields of a heatmap cell without records.
+def _empty_cell_fields(cell_x, cell_y):
+    lon, lat = get_cell_centers(cell_x, cell_y)
+    return {
+        "location": Point(float(lon), float(lat), srid=4326),
+        "histogram": [0] * HISTOGRAM_BUCKETS,
+    }
+
+
+# This function will return the heatmap cell objects of the aggregated cells.
+def _build_cells(cells):
+    lons, lats = get_cell_centers(cells["cell_x"], cells["cell_y"])
+    return [
+        SpeedHeatmapCell(
+            location=Point(float(lon), float(lat), srid=4326),
+            **{field: cells[field][i].tolist() for field in CELL_FIELDS},
+        )
+        for i, (lon, lat) in enumerate(zip(lons, lats))
+    ]
+
+
+# This function will return a filter matching the given (cell_x, cell_y) cells.
+def _cells_filter(keys):
+    return reduce(or_, (Q(cell_x=cell_x, cell_y=cell_y) for cell_x, cell_y in keys))
+
+
+# This function will lock the given cells, creating the missing ones first so a cell being
+# created by an ingest right now is waited for too. Must run inside a transaction.
+def _lock_cells(keys):
+    SpeedHeatmapCell.objects.bulk_create(
+        [
+            SpeedHeatmapCell(
+                cell_x=cell_x, cell_y=cell_y, **_empty_cell_fields(cell_x, cell_y)
+            )
+            for cell_x, cell_y in keys
+        ],
+        ignore_conflicts=True,
+    )
+    list(
+        SpeedHeatmapCell.objects.select_for_update()
+        .filter(_cells_filter(keys))
+        .order_by("cell_x", "cell_y")
+        .values_list("id", flat=True)
+    )
+
+
+# This function will return a filter matching the speed records inside the given cells. The
+# bounds are widened a little so rounding never leaves out a record, the extra records are
+# dropped once grouped into cells.
+def _cell_records_filter(keys):
+    margin = CELL_SIZE / 1000
+    return reduce(
+        or_,
+        (
+            Q(
+                latitude__gte=cell_y * CELL_SIZE - margin,
+                latitude__lt=(cell_y + 1) * CELL_SIZE + margin,
+                longitude__gte=cell_x * CELL_SIZE - margin,
+                longitude__lt=(cell_x + 1) * CELL_SIZE + margin,
+            )
+            for cell_x, cell_y in keys
+        ),
+    )
+
+
+# This function will return the sorted grid cells containing the given speed records.
+def _get_record_cells(records):
+    coordinates = np.array(
+        records.values_list("latitude", "longitude"), dtype=float
+    ).reshape(-1, 2)
+    cell_x, cell_y = get_cells(coordinates[:, 0], coordinates[:, 1])
+    return sorted(set(zip(cell_x.tolist(), cell_y.tolist())))
+
+
+# This function will recompute the given cells in batches, each batch in its own transaction
+# so an ingest only ever waits for the batch holding its cell.
+def _refresh_batches(keys):
+    return sum(
+        _refresh_cells(keys[start : start + REFRESH_BATCH_SIZE])
+        for start in range(0, len(keys), REFRESH_BATCH_SIZE)
+    )
+
+
+# This function will recompute only the heatmap cells containing the given speed records.
+# Cells are recomputed from all their records, so running it twice is harmless.
+def refresh_heatmap(changed_records):
+    return _refresh_batches(_get_record_cells(changed_records))
+
+
+# This function will rebuild the whole heatmap rollup from the plausible speed records. Cells
+# without plausible records anymore are refreshed too, which deletes them.
+def rebuild_heatmap():
+    keys = set(_get_record_cells(SpeedRecord.objects.filter(is_outlier=False)))
+    keys.update(SpeedHeatmapCell.objects.values_list("cell_x", "cell_y"))
+    return _refresh_batches(sorted(keys))
+
+
+# This function will recompute the given cells from their records only.
+@transaction.atomic
+def _refresh_cells(keys):
+    _lock_cells(keys)
+
+    records = np.array(
+        SpeedRecord.objects.filter(_cell_records_filter(keys), is_outlier=False)
+        .values_list("latitude", "longitude", "speed_difference"),
+        dtype=float,
+    ).reshape(-1, 3)
+    keys = set(keys)
+    updated_cells = [
+        cell
+        for cell in _build_cells(
+            aggregate_records(records[:, 0], records[:, 1], records[:, 2])
+        )
+        if (cell.cell_x, cell.cell_y) in keys
+    ]
+    SpeedHeatmapCell.objects.bulk_create(
+        updated_cells,
+        update_conflicts=True,
+        unique_fields=["cell_x", "cell_y"],
+        update_fields=[*CELL_FIELDS[2:], "updated_at"],
+    )
+
+    # Cells left without plausible records
+    empty = keys - {(cell.cell_x, cell.cell_y) for cell in updated_cells}
+    if empty:
+        SpeedHeatmapCell.objects.filter(_cells_filter(empty)).delete()
+    return len(updated_cells)
+
+
+# This function will load the heatmap rollup, optionally merged into coarser cells.
+def get_heatmap_cells(factor=1):
+    rows = list(
+        SpeedHeatmapCell.objects.filter(record_count__gt=0).values_list(*CELL_FIELDS)
+    )
+    cells = {
+        field: np.array([row[i] for row in rows], dtype=np.int64)
+        for i, field in enumerate(CELL_FIELDS)
+    }
+    cells["histogram"] = cells["histogram"].reshape(-1, HISTOGRAM_BUCKETS)
+    if factor > 1:
+        cells = merge_cells(cells, factor)
+    return cells
@@ -0,0 +1,90 @@
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+
+# Database alias used by the reads of the analytics endpoint currently running, if any.
+_analytics_alias = ContextVar("analytics_alias", default=None)
+
+# The analytics queries run on their own threads, off the thread the /speed-info writes run
+# on. Django opens one connection per thread and alias, so this pool also caps the analytics
+# connections of the process at ANALYTICS_MAX_CONNECTIONS.
+_analytics_executor = ThreadPoolExecutor(
+    max_workers=settings.ANALYTICS_MAX_CONNECTIONS, thread_name_prefix="analytics"
+)
+
+
+class AnalyticsUnavailable(Exception):
+    pass
+
+
+# Sends the reads of the analytics endpoints to the replica aliases, everything else to default.
+class AnalyticsRouter:
+    def db_for_read(self, model, **hints):
+        return _analytics_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas mirror the default database
+        return db == "default"
+
+
+# This context manager will route the reads to one of the analytics databases and cancel any
+# query running longer than the statement timeout configured for the endpoint.
+@contextmanager
+def analytics_db(endpoint):
+    alias = random.choice(settings.ANALYTICS_DATABASES)
+    timeout = settings.ANALYTICS_STATEMENT_TIMEOUTS.get(
+        endpoint, settings.ANALYTICS_STATEMENT_TIMEOUT
+    )
+    token = _analytics_alias.set(alias)
+    try:
+        # SET LOCAL only lasts until the end of the transaction, so the timeout does not leak
+        # into the next request reusing the connection
+        with transaction.atomic(using=alias):
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", [timeout])
+            yield alias
+    finally:
+        _analytics_alias.reset(token)
+
+
+# This function will run a read-only function on the analytics databases, on one of the
+# analytics threads. A request that cannot get a thread within ANALYTICS_QUEUE_TIMEOUT is
+# rejected right away, its queued call is dropped instead of piling up behind slow queries.
+async def run_analytics(endpoint, function, *args):
+    # Taken by whichever comes first, the analytics thread starting the call or the timeout
+    claim = threading.Lock()
+
+    def run():
+        if not claim.acquire(blocking=False):
+            return None
+        try:
+            with analytics_db(endpoint):
+                return function(*args)
+        except OperationalError as e:
+            # The replica is unreachable or the query was cancelled by the statement timeout
+            raise AnalyticsUnavailable(f"Analytics database unavailable: {e}") from e
+        finally:
+            # Honours the CONN_MAX_AGE of the analytics aliases
+            for alias in settings.ANALYTICS_DATABASES:
+                connections[alias].close_if_unusable_or_obsolete()
+
+    future = asyncio.get_running_loop().run_in_executor(
+        _analytics_executor, copy_context().run, run
+    )
+    done, _ = await asyncio.wait({future}, timeout=settings.ANALYTICS_QUEUE_TIMEOUT)
+    if not done and claim.acquire(blocking=False):
+        future.cancel()
+        raise AnalyticsUnavailable("Too many analytics requests, try again later")
+    return await future
@@ -1,8 +1,18 @@
+from typing import Optional
+
 from ninja import Schema
 
+from .models import Job
+
 
 # This schema will be used to validate the request body of the /speed-limit endpoint.
 class SpeedRequestSchema(Schema):
     lat: float
     lon: float
     user_speed: int
+    device_id: Optional[str] = None
+
+
+# This schema will be used to validate the request body of the /jobs endpoint.
+class JobRequestSchema(Schema):
+    kind: Job.Kind
@@ -1,3 +1,519 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.filters import (
+    flag_outliers,
+    get_recent_fixes,
+    implied_speeds,
+    is_outlier_fix,
+    rolling_median,
+)
+from api.jobs import JOB_LEASE, claim_job, enqueue_job, execute_job
+from api.models import HISTOGRAM_BUCKETS, Job, SpeedHeatmapCell, SpeedRecord, Trip
+from api.rollups import (
+    aggregate_records,
+    histogram_percentiles,
+    merge_cells,
+    rebuild_heatmap,
+    refresh_heatmap,
+    save_speed_record,
+)
+from api.routers import AnalyticsRouter, analytics_db
+
+
+class OutlierFilterTest(SimpleTestCase):
+    def test_implied_speeds(self):
+        # Roughly 1.1 km north in 60 seconds, about 67 km/h
+        speeds = implied_speeds([52.5200, 52.5300], [13.4050, 13.4050], [0, 60])
+        self.assertEqual(speeds[0], 0)
+        self.assertAlmostEqual(speeds[1], 66.7, delta=0.5)
+
+    def test_implied_speeds_duplicate_fix(self):
+        speeds = implied_speeds([52.52, 52.52], [13.405, 13.405], [0, 0])
+        self.assertEqual(list(speeds), [0, 0])
+
+    def test_rolling_median(self):
+        medians = rolling_median([50, 52, 400, 51, 53], window=3)
+        self.assertEqual(list(medians), [50, 51, 52, 52, 53])
+
+    def test_flag_speed_bounds(self):
+        outliers = flag_outliers(
+            [52.52] * 3, [13.405] * 3, [50, -5, 900], [0, 60, 120]
+        )
+        self.assertEqual(list(outliers), [False, True, True])
+
+    def test_flag_median_deviation(self):
+        outliers = flag_outliers(
+            [52.52] * 5, [13.405] * 5, [50, 52, 200, 51, 53], [0, 60, 120, 180, 240]
+        )
+        self.assertEqual(list(outliers), [False, False, True, False, False])
+
+    def test_flag_gps_jump(self):
+        latitudes = [52.5200, 52.5201, 53.5200]
+        longitudes = [13.4050, 13.4051, 13.4050]
+        outliers = flag_outliers(latitudes, longitudes, [50, 50, 50], [0, 1, 2])
+        self.assertEqual(list(outliers), [False, False, True])
+
+        outliers = flag_outliers(
+            latitudes, longitudes, [50, 50, 50], [0, 1, 2], check_implied_speed=False
+        )
+        self.assertFalse(outliers.any())
+
+    def create_fix(self, speed, minutes_ago, is_outlier=False, lat=52.5200):
+        return SimpleNamespace(
+            latitude=lat,
+            longitude=13.4050,
+            current_speed=speed,
+            timestamp=timezone.now() - timedelta(minutes=minutes_ago),
+            is_outlier=is_outlier,
+        )
+
+    def test_fix_without_history_is_only_bound_checked(self):
+        now = timezone.now()
+        self.assertFalse(is_outlier_fix(52.52, 13.405, 115, now, [], "car"))
+        self.assertTrue(is_outlier_fix(52.52, 13.405, 400, now, [], "car"))
+
+    def test_sustained_speed_change_recovers(self):
+        # Town speed fixes followed by highway fixes, flagged ones are part of the history
+        fixes = [self.create_fix(30, 10 - i) for i in range(4)]
+        flags = []
+        for _ in range(3):
+            flag = is_outlier_fix(52.52, 13.405, 115, timezone.now(), fixes[-4:], "car")
+            flags.append(flag)
+            fixes.append(self.create_fix(115, 0, is_outlier=flag))
+        self.assertEqual(flags, [True, True, False])
+
+    def test_speeder_without_device_is_kept(self):
+        # Other vehicles nearby at 45 km/h, a driver at 130 km/h is only flagged when the
+        # slow fixes are its own
+        fixes = [self.create_fix(45, 4 - i) for i in range(4)]
+        now = timezone.now()
+        self.assertFalse(is_outlier_fix(52.52, 13.405, 130, now, fixes))
+        self.assertTrue(is_outlier_fix(52.52, 13.405, 400, now, fixes))
+        self.assertTrue(is_outlier_fix(52.52, 13.405, 130, now, fixes, "car"))
+
+    def test_gps_jump_is_measured_from_last_plausible_fix(self):
+        fixes = [
+            self.create_fix(50, 2),
+            self.create_fix(50, 1, is_outlier=True, lat=53.52),
+        ]
+        now = timezone.now()
+        self.assertFalse(is_outlier_fix(52.5201, 13.405, 50, now, fixes, "car"))
+        self.assertTrue(is_outlier_fix(53.52, 13.405, 50, now, fixes, "car"))
+
+
+class RecentFixesTest(TestCase):
+    def test_recent_fixes_are_time_bounded(self):
+        old_fix = SpeedRecord.objects.create(
+            latitude=52.5200,
+            longitude=13.4050,
+            current_speed=30,
+            road_speed_limit=50,
+            speed_difference=0,
+            device_id="car",
+        )
+        SpeedRecord.objects.filter(id=old_fix.id).update(
+            timestamp=timezone.now() - timedelta(days=1)
+        )
+        self.assertEqual(get_recent_fixes("car"), [])
+
+        flagged_fix = SpeedRecord.objects.create(
+            latitude=52.5200,
+            longitude=13.4050,
+            current_speed=115,
+            road_speed_limit=50,
+            speed_difference=65,
+            device_id="car",
+            is_outlier=True,
+        )
+        self.assertEqual(get_recent_fixes("car"), [flagged_fix])
+
+
+# Overpass response with a single 50 km/h road next to the test location
+ROAD_DATA = {
+    "elements": [
+        {
+            "geometry": [
+                {"lat": 52.5199, "lon": 13.4049},
+                {"lat": 52.5201, "lon": 13.4051},
+            ],
+            "tags": {"maxspeed": "50"},
+        }
+    ]
+}
+
+
+@mock.patch("api.api.get_nearest_road", mock.AsyncMock(return_value=ROAD_DATA))
+class SpeedInfoTest(TestCase):
+    def post_speed(self, user_speed):
+        payload = {
+            "lat": 52.5200,
+            "lon": 13.4050,
+            "user_speed": user_speed,
+            "device_id": "car",
+        }
+        return self.client.post(
+            "/api/speed-info", data=json.dumps(payload), content_type="application/json"
+        )
+
+    def test_outliers_are_stored_and_left_out_of_the_heatmap(self):
+        response = self.post_speed(60)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["is_outlier"])
+        self.assertTrue(self.post_speed(400).json()["is_outlier"])
+
+        records = SpeedRecord.objects.order_by("id")
+        self.assertEqual([record.is_outlier for record in records], [False, True])
+        cell = SpeedHeatmapCell.objects.get()
+        self.assertEqual(cell.record_count, 1)
+        self.assertEqual(cell.max_speed_difference, 10)
+
+
+class HeatmapRollupTest(SimpleTestCase):
+    def test_aggregate_records(self):
+        cells = aggregate_records(
+            [52.52001, 52.52002, 52.53], [13.40501, 13.40502, 13.41], [10, 20, 5]
+        )
+        self.assertEqual(list(cells["record_count"]), [2, 1])
+        self.assertEqual(list(cells["speed_difference_sum"]), [30, 5])
+        self.assertEqual(list(cells["min_speed_difference"]), [10, 5])
+        self.assertEqual(list(cells["max_speed_difference"]), [20, 5])
+        self.assertEqual(cells["histogram"][0][10], 1)
+        self.assertEqual(cells["histogram"][0][20], 1)
+
+    def test_histogram_overflow_bucket(self):
+        cells = aggregate_records([52.52], [13.405], [500])
+        self.assertEqual(cells["histogram"][0][HISTOGRAM_BUCKETS - 1], 1)
+
+    def test_histogram_percentiles(self):
+        histogram = np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64)
+        histogram[:100] = 1
+        self.assertEqual(list(histogram_percentiles(histogram)[0]), [49, 84, 94])
+
+    def test_merge_matches_raw_aggregation(self):
+        latitudes = [52.5200, 52.5204, 52.5209, 52.5301]
+        longitudes = [13.4050, 13.4054, 13.4059, 13.4151]
+        speed_differences = [0, 12, 30, 7]
+
+        merged = merge_cells(
+            aggregate_records(latitudes, longitudes, speed_differences), 4
+        )
+        self.assertEqual(list(merged["record_count"]), [3, 1])
+        self.assertEqual(list(merged["speed_difference_sum"]), [42, 7])
+        self.assertEqual(list(merged["max_speed_difference"]), [30, 7])
+        self.assertEqual(list(histogram_percentiles(merged["histogram"])[0]), [12, 30, 30])
+
+
+class HeatmapRefreshTest(TestCase):
+    def save_record(self, speed_difference, is_outlier=False):
+        record = SpeedRecord(
+            latitude=52.5200,
+            longitude=13.4050,
+            current_speed=50 + speed_difference,
+            road_speed_limit=50,
+            speed_difference=speed_difference,
+            is_outlier=is_outlier,
+        )
+        save_speed_record(record)
+        return record
+
+    def test_refresh_does_not_count_ingested_records_twice(self):
+        self.save_record(10)
+        self.save_record(30)
+        refresh_heatmap(SpeedRecord.objects.all())
+
+        cell = SpeedHeatmapCell.objects.get()
+        self.assertEqual(cell.record_count, 2)
+        self.assertEqual(cell.speed_difference_sum, 40)
+
+    def test_refresh_only_recomputes_changed_cells(self):
+        # Berlin and Munich changed, Leipzig in between did not
+        for lat, lon in [(52.5200, 13.4050), (48.1372, 11.5756), (51.3397, 12.3731)]:
+            SpeedRecord.objects.create(
+                latitude=lat,
+                longitude=lon,
+                current_speed=60,
+                road_speed_limit=50,
+                speed_difference=10,
+            )
+        changed = SpeedRecord.objects.exclude(latitude=51.3397)
+
+        self.assertEqual(refresh_heatmap(changed), 2)
+        self.assertEqual(SpeedHeatmapCell.objects.count(), 2)
+
+    def test_refresh_removes_cells_without_plausible_records(self):
+        record = self.save_record(10)
+        SpeedRecord.objects.filter(id=record.id).update(is_outlier=True)
+        self.assertEqual(refresh_heatmap(SpeedRecord.objects.all()), 0)
+        self.assertFalse(SpeedHeatmapCell.objects.exists())
+
+    def test_rebuild_recomputes_every_cell(self):
+        self.save_record(10)
+        self.save_record(30)
+        # Rollups out of date with the records, then a cell left without records
+        stale = self.save_record(20)
+        SpeedRecord.objects.filter(id=stale.id).update(latitude=48.1372)
+        SpeedHeatmapCell.objects.update(record_count=99)
+
+        self.assertEqual(rebuild_heatmap(), 2)
+        cells = SpeedHeatmapCell.objects.order_by("cell_y")
+        self.assertEqual([cell.record_count for cell in cells], [1, 2])
+        SpeedRecord.objects.filter(id=stale.id).delete()
+        self.assertEqual(rebuild_heatmap(), 1)
+        self.assertEqual(SpeedHeatmapCell.objects.get().speed_difference_sum, 40)
+
+
+class JobQueueTest(TestCase):
+    def create_record(self, speed_difference):
+        return SpeedRecord.objects.create(
+            latitude=52.5200,
+            longitude=13.4050,
+            current_speed=30 + speed_difference,
+            road_speed_limit=30,
+            speed_difference=speed_difference,
+        )
+
+    def test_enqueue_job_deduplicates(self):
+        job = enqueue_job(Job.Kind.SPEED_HEATMAP)
+        self.assertEqual(enqueue_job(Job.Kind.SPEED_HEATMAP), job)
+        self.assertNotEqual(enqueue_job(Job.Kind.TRIP_HEATMAP), job)
+
+    def test_one_active_job_per_kind(self):
+        Job.objects.create(kind=Job.Kind.SPEED_HEATMAP)
+        with self.assertRaises(IntegrityError):
+            Job.objects.create(kind=Job.Kind.SPEED_HEATMAP)
+
+    def test_lost_job_does_not_block_its_kind(self):
+        enqueue_job(Job.Kind.SPEED_HEATMAP)
+        lost_job = claim_job()
+        Job.objects.filter(id=lost_job.id).update(
+            heartbeat_at=timezone.now() - JOB_LEASE - timedelta(seconds=1)
+        )
+
+        job = enqueue_job(Job.Kind.SPEED_HEATMAP)
+        self.assertNotEqual(job, lost_job)
+        lost_job.refresh_from_db()
+        self.assertEqual(lost_job.status, Job.Status.FAILED)
+
+    def test_failing_job_is_marked_failed(self):
+        enqueue_job(Job.Kind.SPEED_HEATMAP)
+        job = claim_job()
+        with mock.patch.dict(
+            "api.jobs.JOB_RUNNERS",
+            {Job.Kind.SPEED_HEATMAP: mock.Mock(side_effect=ValueError("boom"))},
+        ):
+            execute_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertEqual(job.error, "boom")
+
+    def test_speed_heatmap_job_is_incremental(self):
+        self.create_record(10)
+        enqueue_job(Job.Kind.SPEED_HEATMAP)
+        execute_job(claim_job().id)
+        self.assertIsNone(claim_job())
+
+        cell = SpeedHeatmapCell.objects.get()
+        self.assertEqual(cell.record_count, 1)
+
+        record = self.create_record(20)
+        enqueue_job(Job.Kind.SPEED_HEATMAP)
+        execute_job(claim_job().id)
+
+        job = Job.objects.latest("finished_at")
+        self.assertEqual(job.status, Job.Status.DONE)
+        self.assertEqual(job.last_record_id, record.id)
+        self.assertEqual(job.result, {"updated_cells": 1})
+        cell.refresh_from_db()
+        self.assertEqual(cell.record_count, 2)
+        self.assertEqual(cell.max_speed_difference, 20)
+
+
+class TripHeatmapJobTest(TestCase):
+    def create_record(self, device_id, lon):
+        return SpeedRecord.objects.create(
+            latitude=52.5200,
+            longitude=lon,
+            current_speed=60,
+            road_speed_limit=50,
+            speed_difference=10,
+            device_id=device_id,
+        )
+
+    def run_job(self):
+        enqueue_job(Job.Kind.TRIP_HEATMAP)
+        execute_job(claim_job().id)
+
+    def get_coordinates(self, device_id):
+        trip = Trip.objects.get(device_id=device_id)
+        return [lon for lon, _ in trip.feature["geometry"]["coordinates"]]
+
+    def test_trips_are_built_per_device_and_extended(self):
+        # Two vehicles reporting at the same time, a record without device is left out
+        self.create_record("car", 13.4050)
+        self.create_record("bus", 13.5050)
+        self.create_record("car", 13.4060)
+        self.create_record("bus", 13.5060)
+        self.create_record(None, 13.6050)
+        self.run_job()
+
+        self.assertEqual(self.get_coordinates("car"), [13.4050, 13.4060])
+        self.assertEqual(self.get_coordinates("bus"), [13.5050, 13.5060])
+
+        self.create_record("car", 13.4070)
+        self.run_job()
+
+        self.assertEqual(Trip.objects.count(), 2)
+        self.assertEqual(self.get_coordinates("car"), [13.4050, 13.4060, 13.4070])
+        # About 135 m of trip, interpolated every 100 m
+        properties = Trip.objects.get(device_id="car").feature["properties"]
+        self.assertEqual(properties["interpolated_speed_differences"], [10, 10])
+        self.assertEqual(len(properties["interpolated_points"]), 2)
+        self.assertAlmostEqual(properties["interpolated_points"][1][0], 13.4065, 4)
+        self.assertEqual(
+            Job.objects.latest("finished_at").result, {"updated_trips": 1}
+        )
+
+    def test_first_run_replaces_every_trip(self):
+        now = timezone.now()
+        for device_id in ("car", "gone"):
+            Trip.objects.create(device_id=device_id, started_at=now, ended_at=now)
+        self.create_record("car", 13.4050)
+        self.create_record("car", 13.4060)
+        self.run_job()
+
+        self.assertEqual(self.get_coordinates("car"), [13.4050, 13.4060])
+        self.assertFalse(Trip.objects.filter(device_id="gone").exists())
+
+
+class AnalyticsRouterTest(SimpleTestCase):
+    def test_routes_to_default_outside_analytics_endpoints(self):
+        router = AnalyticsRouter()
+        self.assertIsNone(router.db_for_read(SpeedRecord))
+        self.assertEqual(router.db_for_write(SpeedRecord), "default")
+        self.assertTrue(router.allow_migrate("default", "api"))
+        self.assertFalse(router.allow_migrate("analytics_0", "api"))
+
+
+class AnalyticsDatabaseTest(TestCase):
+    databases = {"default", "analytics_0"}
+
+    def test_reads_go_to_an_analytics_database(self):
+        with analytics_db("speed-heatmap") as alias:
+            self.assertEqual(alias, "analytics_0")
+            self.assertEqual(SpeedHeatmapCell.objects.all().db, "analytics_0")
+        self.assertEqual(SpeedHeatmapCell.objects.all().db, "default")
+
+    def test_statement_timeout_is_set(self):
+        with CaptureQueriesContext(connections["analytics_0"]) as queries:
+            with analytics_db("speed-heatmap"):
+                list(SpeedHeatmapCell.objects.all())
+
+        self.assertIn("SET LOCAL statement_timeout", queries[0]["sql"])
+        self.assertIn(
+            str(settings.ANALYTICS_STATEMENT_TIMEOUTS["speed-heatmap"]),
+            queries[0]["sql"],
+        )
+        self.assertIn(SpeedHeatmapCell._meta.db_table, queries[1]["sql"])
+
+    @override_settings(ANALYTICS_QUEUE_TIMEOUT=0.1)
+    def test_over_budget_request_returns_503(self):
+        # Keep the only analytics thread busy until the request is answered
+        executor = ThreadPoolExecutor(max_workers=1)
+        busy = threading.Event()
+        executor.submit(busy.wait, 5)
+        start = time.monotonic()
+        with mock.patch("api.routers._analytics_executor", executor):
+            response = self.client.get("/api/speed-heatmap")
+        elapsed = time.monotonic() - start
+        busy.set()
+        executor.shutdown()
+
+        self.assertEqual(response.status_code, 503)
+        # Rejected after the queue timeout, not once the busy thread is free
+        self.assertLess(elapsed, 1)
+
+    def test_cancelled_query_returns_503(self):
+        error = OperationalError("canceling statement due to statement timeout")
+        with mock.patch("api.rollups.get_heatmap_cells", side_effect=error):
+            response = self.client.get("/api/speed-heatmap")
+
+        self.assertEqual(response.status_code, 503)
+
+    def test_cancelled_trip_query_returns_503(self):
+        error = OperationalError("canceling statement due to statement timeout")
+        with mock.patch("api.api.get_trip_features", side_effect=error):
+            response = self.client.get("/api/trip-heatmap")
+
+        self.assertEqual(response.status_code, 503)
+
+    def test_unreachable_replica_returns_503(self):
+        error = OperationalError("could not connect to server")
+        with mock.patch("api.routers.transaction.atomic", side_effect=error):
+            response = self.client.get("/api/speed-heatmap")
+
+        self.assertEqual(response.status_code, 503)
+
+
+# Maximum time (seconds) a production worker may spend loading Django and the URL conf. The
+# production startup measures about 0.3 s on a development machine, the rest is headroom.
+STARTUP_TIME_BUDGET = 1.0
+
+# Modules the views import on first use, a production worker must not load them at startup
+LAZY_MODULES = ("numpy", "httpx", "shapely", "geojson")
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import CopperBackend.urls
+print(json.dumps({"elapsed": time.perf_counter() - start, "modules": list(sys.modules)}))
+"""
+
+
+class StartupTest(SimpleTestCase):
+    # This function will return the fastest of a few production startups and the modules it
+    # loaded.
+    def measure_startup(self, runs=3):
+        startups = []
+        for _ in range(runs):
+            # Measure in a fresh interpreter, the test runner has already imported everything
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT],
+                cwd=settings.BASE_DIR,
+                env={
+                    **os.environ,
+                    "DJANGO_SETTINGS_MODULE": "CopperBackend.settings",
+                    "DJANGO_ENV": "production",
+                },
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            startups.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        return min(startups, key=lambda startup: startup["elapsed"])
+
+    def test_production_startup_is_lean(self):
+        startup = self.measure_startup()
+
+        self.assertLess(startup["elapsed"], STARTUP_TIME_BUDGET)
+        dev_modules = ("django_extensions", "django.contrib.admin.sites")
+        for module in (*LAZY_MODULES, *dev_modules):
+            self.assertNotIn(module, startup["modules"])
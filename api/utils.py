@@ -1,6 +1,11 @@
 # Function to parse the data into multiple trips
+from math import cos, radians
+
 from shapely import LineString, Point
 
+# Meters per degree of latitude, used to measure trips in meters
+METERS_PER_DEGREE = 111320
+
 
 def segment_trips(speed_records, time_threshold=30):
     trips = []
@@ -23,21 +28,31 @@ def segment_trips(speed_records, time_threshold=30):
     return trips
 
 
+# Function to project (lon, lat) coordinates to meters around the latitude of a trip, which is
+# accurate enough over the length of a trip
+def to_meters(lon, lat, origin_lat):
+    return lon * METERS_PER_DEGREE * cos(radians(origin_lat)), lat * METERS_PER_DEGREE
+
+
+def to_degrees(x, y, origin_lat):
+    return x / (METERS_PER_DEGREE * cos(radians(origin_lat))), y / METERS_PER_DEGREE
+
+
+# Interpolates the speed differences of a trip every interval meters, the points are returned
+# in (lon, lat)
 def interpolate_speed_differences(trip, interval=100):
     if not trip:
-        print("Trip is empty")
         return [], []
 
-    line = LineString([(record.longitude, record.latitude) for record in trip])
-    distances = [
-        line.project(Point(record.longitude, record.latitude)) for record in trip
+    origin_lat = trip[0].latitude
+    points = [
+        Point(to_meters(record.longitude, record.latitude, origin_lat))
+        for record in trip
     ]
+    line = LineString(points)
+    distances = [line.project(point) for point in points]
     speed_differences = [record.speed_difference for record in trip]
 
-    print(f"LineString length: {line.length}")
-    print(f"Distances: {distances}")
-    print(f"Speed differences: {speed_differences}")
-
     # Interpolating speed differences at regular intervals
     total_length = line.length
     num_points = int(total_length // interval)
@@ -46,9 +61,6 @@ def interpolate_speed_differences(trip, interval=100):
     ]
     interpolated_speeds = [None] * len(interpolated_points)
 
-    print(f"Total length: {total_length}")
-    print(f"Number of interpolated points: {len(interpolated_points)}")
-
     for i in range(len(interpolated_points)):
         interpolated_point_distance = line.project(interpolated_points[i])
         for j in range(len(distances) - 1):
@@ -57,9 +69,6 @@ def interpolate_speed_differences(trip, interval=100):
                     interpolated_speeds[i] = (
                         speed_differences[j] + speed_differences[j + 1]
                     ) / 2
-                print(
-                    f"Interpolated point {i} at distance {interpolated_point_distance}: speed = {interpolated_speeds[i]}"
-                )
                 break
 
     # Filter out None values (which represent ignored 0 values)
@@ -70,7 +79,7 @@ def interpolate_speed_differences(trip, interval=100):
     ]
     interpolated_speeds = [spd for spd in interpolated_speeds if spd is not None]
 
-    print(f"Final interpolated points: {len(interpolated_points)}")
-    print(f"Final interpolated speeds: {len(interpolated_speeds)}")
-
+    interpolated_points = [
+        Point(to_degrees(pt.x, pt.y, origin_lat)) for pt in interpolated_points
+    ]
     return interpolated_points, interpolated_speeds